@@ -1,5 +1,6 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import streamlit as st
@@ -9,6 +10,28 @@ from src.student.inference import chat, load_student
 
 st.set_page_config(page_title="CPA Teacher vs Student", page_icon="📚", layout="wide")
 
+
+@st.cache_resource
+def _cached_load_student(base: str, lora: str):
+    # 每个进程只加载一次基座 + LoRA，避免每次 rerun 都重新读盘占用显存
+    return load_student(base, Path(lora))
+
+
+@st.cache_resource
+def _planner_agent() -> PlannerAgent:
+    return PlannerAgent()
+
+
+@st.cache_resource
+def _writer_agent() -> WriterAgent:
+    return WriterAgent()
+
+
+@st.cache_resource
+def _reviewer_agent() -> ReviewerAgent:
+    return ReviewerAgent()
+
+
 st.markdown(
     """
     <style>
@@ -61,30 +84,54 @@ with st.sidebar:
     st.divider()
     st.caption("提示：可在主界面使用批量合成获得 200+ 条训练样本")
 
-mode = st.radio("选择回答方", options=["Teacher", "Student", "对比"], index=2, horizontal=True)
-question = st.text_area("请输入 CPA 问题", value="什么是资本成本？", height=120)
+# 表单内的控件修改不会触发 rerun，只有点击提交才执行生成
+with st.form("qa_form"):
+    mode = st.radio("选择回答方", options=["Teacher", "Student", "对比"], index=2, horizontal=True)
+    question = st.text_area("请输入 CPA 问题", value="什么是资本成本？", height=120)
+    submitted = st.form_submit_button("生成回答", type="primary")
 
 col_action, col_meta = st.columns([2, 1])
 with col_action:
-    if st.button("生成回答", type="primary"):
+    if submitted:
         teacher_answer = None
         student_answer = None
 
-        if mode in {"Teacher", "对比"}:
-            writer = WriterAgent()
+        if mode == "Teacher":
+            writer = _writer_agent()
             with st.spinner("Teacher 正在回答..."):
                 teacher_answer = writer.answer_question(question)
-
-        if mode in {"Student", "对比"}:
+        elif mode == "Student":
             with st.spinner("Student 正在加载权重并作答..."):
-                tokenizer, model = load_student(student_base, Path(lora_path))
+                tokenizer, model = _cached_load_student(student_base, str(lora_path))
                 student_answer = chat(tokenizer, model, question)
+        else:
+            # Teacher 走网络 IO、Student 走 GPU，二者互不依赖，并行执行；
+            # 模型加载留在主线程，st.cache_resource 需要 Streamlit 的脚本上下文
+            with st.spinner("Teacher 与 Student 正在同时作答..."):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    teacher_future = executor.submit(_writer_agent().answer_question, question)
+                    tokenizer, model = _cached_load_student(student_base, str(lora_path))
+                    student_future = executor.submit(chat, tokenizer, model, question)
+                    teacher_answer = teacher_future.result()
+                    student_answer = student_future.result()
 
-        tabs = st.tabs(["Teacher", "Student"] if mode == "对比" else [mode])
-        if mode == "Teacher":
+        # 结果存入 session_state，提交反馈表单引起的 rerun 不会丢失回答
+        st.session_state["qa_result"] = {
+            "mode": mode,
+            "question": question,
+            "teacher": teacher_answer,
+            "student": student_answer,
+        }
+
+    result = st.session_state.get("qa_result")
+    if result:
+        teacher_answer = result["teacher"]
+        student_answer = result["student"]
+        tabs = st.tabs(["Teacher", "Student"] if result["mode"] == "对比" else [result["mode"]])
+        if result["mode"] == "Teacher":
             with tabs[0]:
                 st.markdown("<div class='card'>" + (teacher_answer or "暂无回答") + "</div>", unsafe_allow_html=True)
-        elif mode == "Student":
+        elif result["mode"] == "Student":
             with tabs[0]:
                 st.markdown("<div class='card'>" + (student_answer or "暂无回答") + "</div>", unsafe_allow_html=True)
         else:
@@ -93,11 +140,13 @@ with col_action:
             with tabs[1]:
                 st.markdown("<div class='card'>" + (student_answer or "暂无回答") + "</div>", unsafe_allow_html=True)
 
-        rating = st.slider("请对 Student 回答打分 (1-5)", 1, 5, 3)
-        feedback = st.text_input("改进建议")
-        if st.button("保存反馈"):
+        with st.form("feedback_form"):
+            rating = st.slider("请对 Student 回答打分 (1-5)", 1, 5, 3)
+            feedback = st.text_input("改进建议")
+            feedback_submitted = st.form_submit_button("保存反馈")
+        if feedback_submitted:
             log = {
-                "question": question,
+                "question": result["question"],
                 "teacher": teacher_answer,
                 "student": student_answer,
                 "rating": rating,
@@ -126,10 +175,7 @@ with st.expander("🚀 批量合成教学样本", expanded=True):
         st.caption("提示：多智能体会循环大纲要点，确保达到设定数量。")
     with col_right:
         if st.button("开始合成", type="secondary"):
-            planner = PlannerAgent()
-            writer = WriterAgent()
-            reviewer = ReviewerAgent()
-            synth = DatasetSynthesizer(planner, writer, reviewer)
+            synth = DatasetSynthesizer(_planner_agent(), _writer_agent(), _reviewer_agent())
             with st.spinner("正在生成教学样本..."):
                 dataset = synth.build(topic=bulk_topic, num_questions=int(bulk_num))
             jsonl_text = DatasetSynthesizer.to_jsonl(dataset)
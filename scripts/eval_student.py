@@ -3,15 +3,8 @@ import json
 from pathlib import Path
 from typing import Iterable, List
 
-from src.eval.evaluate import compute_metrics
-from src.student.inference import chat, load_student
-
-
-def load_records(path: Path) -> List[dict]:
-    text = path.read_text(encoding="utf-8")
-    if text.lstrip().startswith("["):
-        return json.loads(text)
-    return [json.loads(line) for line in text.splitlines() if line.strip()]
+from src.eval.evaluate import compute_metrics, load_json
+from src.student.inference import generate_batch, load_student
 
 
 def main() -> None:
@@ -21,6 +14,7 @@ def main() -> None:
     parser.add_argument("--lora", type=Path, default=Path("outputs/student_lora"))
     parser.add_argument("--limit", type=int, default=200, help="Max samples to evaluate")
     parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=16, help="Generation batch size")
     parser.add_argument(
         "--pred-output",
         type=Path,
@@ -29,18 +23,21 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    teacher_records = load_records(args.teacher)[: args.limit]
+    teacher_records = load_json(args.teacher)[: args.limit]
 
     tokenizer, model = load_student(args.model, args.lora)
-    preds: List[dict] = []
-    for sample in teacher_records:
-        answer = chat(
-            tokenizer,
-            model,
-            sample["input"],
-            max_new_tokens=args.max_new_tokens,
-        )
-        preds.append({"id": sample["id"], "input": sample["input"], "output": answer})
+    answers = generate_batch(
+        tokenizer,
+        model,
+        [sample["input"] for sample in teacher_records],
+        max_new_tokens=args.max_new_tokens,
+        batch_size=args.batch_size,
+        do_sample=False,
+    )
+    preds: List[dict] = [
+        {"id": sample["id"], "input": sample["input"], "output": answer}
+        for sample, answer in zip(teacher_records, answers)
+    ]
 
     args.pred_output.parent.mkdir(parents=True, exist_ok=True)
     args.pred_output.write_text(json.dumps(preds, ensure_ascii=False, indent=2), encoding="utf-8")
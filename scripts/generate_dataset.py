@@ -1,8 +1,30 @@
 import argparse
-import json
+import os
 from pathlib import Path
+from typing import List
+
+import msgspec
+import orjson
 
 from src.teacher.agents import DatasetSynthesizer, PlannerAgent, ReviewerAgent, WriterAgent
+from src.teacher.dedup import SemanticDeduper
+
+
+# Linux 的 IOV_MAX；超出时退化为单次拼接写
+_IOV_MAX = 1024
+
+
+def _append_lines(fd: int, lines: List[bytes]) -> None:
+    """Gather-write all lines to ``fd`` in one syscall where possible, retrying short writes."""
+    total = sum(len(line) for line in lines)
+    written = 0
+    if hasattr(os, "writev") and len(lines) <= _IOV_MAX:
+        written = os.writev(fd, lines)
+        if written == total:
+            return
+    remaining = memoryview(b"".join(lines))[written:]
+    while remaining:
+        remaining = remaining[os.write(fd, remaining) :]
 
 
 def parse_args() -> argparse.Namespace:
@@ -59,7 +81,7 @@ def main() -> None:
     planner = PlannerAgent()
     writer = WriterAgent()
     reviewer = ReviewerAgent()
-    synth = DatasetSynthesizer(planner, writer, reviewer)
+    synth = DatasetSynthesizer(planner, writer, reviewer, deduper=SemanticDeduper.from_env())
 
     args.output_dir.mkdir(parents=True, exist_ok=True)
     topic_slug = args.topic.replace(" ", "_")
@@ -83,33 +105,35 @@ def main() -> None:
         # 清空旧文件再写
         output_path.write_text("", encoding="utf-8")
 
-    def flush_chunk(chunk):
-        with output_path.open("a", encoding="utf-8") as f:
-            if args.jsonl:
-                for item in chunk:
-                    f.write(json.dumps(item.__dict__, ensure_ascii=False) + "\n")
-            else:
-                # 对 JSON 模式，先累积到内存，最后再重写；这里先写占位，后续覆盖
-                pass
-
-    dataset = synth.build(
-        topic=args.topic,
-        num_questions=args.num_questions,
-        min_score=args.min_score,
-        max_attempts=args.max_attempts,
-        flush_every=args.flush_every if args.jsonl else None,
-        flush_callback=flush_chunk if args.jsonl else None,
-        start_id=args.start_id,
+    # JSONL 模式整个运行期间只打开一次文件，每次 flush 一次 writev
+    fd = (
+        os.open(output_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        if args.jsonl
+        else None
     )
 
+    def flush_chunk(chunk):
+        _append_lines(fd, [msgspec.json.encode(item) + b"\n" for item in chunk])
+
+    try:
+        dataset = synth.build(
+            topic=args.topic,
+            num_questions=args.num_questions,
+            min_score=args.min_score,
+            max_attempts=args.max_attempts,
+            flush_every=args.flush_every if args.jsonl else None,
+            flush_callback=flush_chunk if args.jsonl else None,
+            start_id=args.start_id,
+        )
+    finally:
+        if fd is not None:
+            os.close(fd)
+
     # 如果用户选择 JSON，最终一次性写为列表；JSONL 已经在过程中追加写入
     if args.jsonl:
         final_path = output_path
     else:
-        output_path.write_text(
-            json.dumps([item.__dict__ for item in dataset], ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
+        output_path.write_bytes(orjson.dumps([msgspec.to_builtins(item) for item in dataset], option=orjson.OPT_INDENT_2))
         final_path = output_path
 
     kept_ratio = len(dataset) / max(len(dataset), args.num_questions) * 100
@@ -1,20 +1,38 @@
 import argparse
+import hashlib
+import importlib.util
 import inspect
+import json
+import os
+import shutil
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List
 
-from datasets import load_dataset
+import torch
+from datasets import Dataset, DatasetDict, load_dataset, load_from_disk
 from peft import LoraConfig, get_peft_model
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     BitsAndBytesConfig,
-    DataCollatorForLanguageModeling,
+    DataCollatorForSeq2Seq,
     Trainer,
     TrainingArguments,
 )
 
 
+def attn_implementation(dtype: torch.dtype) -> str:
+    """FlashAttention-2 on CUDA with half-precision weights when installed, fused SDPA otherwise."""
+    # 与 src/student/inference.py 保持一致；训练脚本可独立运行，不依赖 src 包
+    if (
+        torch.cuda.is_available()
+        and dtype in (torch.float16, torch.bfloat16)
+        and importlib.util.find_spec("flash_attn") is not None
+    ):
+        return "flash_attention_2"
+    return "sdpa"
+
+
 def build_argparser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="LoRA/QLoRA fine-tune a student model on teacher QA data")
     parser.add_argument("--data", type=Path, required=True, help="Path to teacher JSON/JSONL dataset")
@@ -28,26 +46,57 @@ def build_argparser() -> argparse.ArgumentParser:
     parser.add_argument("--eval-size", type=int, default=128, help="Max validation examples (speed-up)")
     parser.add_argument("--gradient-accumulation-steps", type=int, default=4)
     parser.add_argument("--qlora", action="store_true", help="Enable 4-bit QLoRA (requires bitsandbytes)")
+    parser.add_argument("--num-proc", type=int, default=os.cpu_count(), help="Processes used for tokenization")
     return parser
 
 
 def preprocess_function(tokenizer, max_length: int):
     def _inner(example: Dict[str, str]):
         prompt = f"用户问题：{example['input']}\n请像 CPA 老师一样回答："
-        text = prompt + example["output"]
-        tokens = tokenizer(
-            text,
-            truncation=True,
-            max_length=max_length,
-            padding="max_length",  # 保证批次对齐，避免 DataCollator 抛 padding 错误
-        )
-        tokens["labels"] = tokens["input_ids"].copy()
+        # 与完整序列使用相同的特殊 token 设置，带 BOS 的分词器也不会错位
+        prompt_len = len(tokenizer(prompt, truncation=True, max_length=max_length)["input_ids"])
+        # 不在此处 padding，由 DataCollatorForSeq2Seq 按批次动态补齐
+        tokens = tokenizer(prompt + example["output"], truncation=True, max_length=max_length)
+        labels = tokens["input_ids"].copy()
+        # 固定的提问前缀不计入 loss，只监督答案部分
+        prompt_len = min(prompt_len, len(labels))
+        labels[:prompt_len] = [-100] * prompt_len
+        tokens["labels"] = labels
         return tokens
 
     return _inner
 
 
-def train(args: argparse.Namespace) -> None:
+def has_target(example: Dict[str, List[int]]) -> bool:
+    """False when truncation left no answer token to supervise."""
+    return any(label != -100 for label in example["labels"])
+
+
+def tokenized_cache_dir(args: argparse.Namespace) -> Path:
+    """Cache location keyed by everything that changes the tokenized output."""
+    stat = args.data.stat()
+    key = json.dumps(
+        [
+            str(args.data.resolve()),
+            stat.st_size,
+            stat.st_mtime_ns,
+            args.model,
+            args.max_length,
+            args.val_ratio,
+            args.eval_size,
+            inspect.getsource(preprocess_function),
+            inspect.getsource(has_target),
+        ]
+    )
+    return args.output_dir / "tokenized_cache" / hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_tokenized(args: argparse.Namespace, tokenizer) -> Dict[str, Dataset]:
+    cache_dir = tokenized_cache_dir(args)
+    if cache_dir.exists():
+        print(f"Loading tokenized dataset from {cache_dir}")
+        return dict(load_from_disk(str(cache_dir)))
+
     dataset = load_dataset("json", data_files=str(args.data))
     if args.val_ratio > 0:
         split = dataset["train"].train_test_split(test_size=args.val_ratio, seed=42)
@@ -56,6 +105,25 @@ def train(args: argparse.Namespace) -> None:
     else:
         dataset = {"train": dataset["train"]}
 
+    tokenized = {}
+    for name, split in dataset.items():
+        num_proc = max(1, min(args.num_proc or 1, len(split)))
+        mapped = split.map(
+            preprocess_function(tokenizer, args.max_length),
+            remove_columns=split.column_names,
+            num_proc=num_proc,
+        )
+        # 提问前缀占满 max_length 的样本没有可监督的答案，跳过以免 loss 出现 NaN
+        tokenized[name] = mapped.filter(has_target, num_proc=num_proc)
+    # 先写临时目录再改名，中途中断不会留下半截缓存
+    tmp_dir = cache_dir.with_name(cache_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    DatasetDict(tokenized).save_to_disk(str(tmp_dir))
+    tmp_dir.rename(cache_dir)
+    return tokenized
+
+
+def train(args: argparse.Namespace) -> None:
     tokenizer = AutoTokenizer.from_pretrained(args.model)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
@@ -72,10 +140,14 @@ def train(args: argparse.Namespace) -> None:
         else None
     )
 
+    # QLoRA 以 bf16 计算，可走 FlashAttention-2；全精度 LoRA 回退到 SDPA
+    dtype = torch.bfloat16 if args.qlora else torch.float32
     model = AutoModelForCausalLM.from_pretrained(
         args.model,
         device_map="auto",
         quantization_config=quant_config,
+        torch_dtype=dtype,
+        attn_implementation=attn_implementation(dtype),
     )
 
     peft_config = LoraConfig(
@@ -85,20 +157,16 @@ def train(args: argparse.Namespace) -> None:
         target_modules=["q_proj", "v_proj"],
     )
     model = get_peft_model(model, peft_config)
+    # 以重算换显存，腾出空间加大 batch；LoRA 冻结了嵌入层，需要让输入带梯度
+    model.gradient_checkpointing_enable()
+    model.enable_input_require_grads()
+    model.config.use_cache = False
 
-    tokenized_train = dataset["train"].map(
-        preprocess_function(tokenizer, args.max_length),
-        remove_columns=dataset["train"].column_names,
-    )
-    tokenized_eval = (
-        dataset.get("validation").map(
-            preprocess_function(tokenizer, args.max_length),
-            remove_columns=dataset["train"].column_names,
-        )
-        if "validation" in dataset
-        else None
-    )
+    tokenized = load_tokenized(args, tokenizer)
+    tokenized_train = tokenized["train"]
+    tokenized_eval = tokenized.get("validation")
 
+    use_cuda = torch.cuda.is_available()
     ta_kwargs = dict(
         output_dir=str(args.output_dir),
         per_device_train_batch_size=args.batch_size,
@@ -109,6 +177,11 @@ def train(args: argparse.Namespace) -> None:
         save_steps=200,
         evaluation_strategy="steps" if tokenized_eval else "no",
         eval_steps=200,
+        gradient_checkpointing=True,
+        optim="paged_adamw_8bit" if use_cuda else "adamw_torch",
+        bf16=use_cuda and torch.cuda.is_bf16_supported(),
+        dataloader_num_workers=4,
+        dataloader_pin_memory=use_cuda,
     )
     # 兼容老版本 transformers，过滤不支持的参数
     valid_keys = set(inspect.signature(TrainingArguments).parameters.keys())
@@ -120,7 +193,7 @@ def train(args: argparse.Namespace) -> None:
         args=training_args,
         train_dataset=tokenized_train,
         eval_dataset=tokenized_eval,
-        data_collator=DataCollatorForLanguageModeling(tokenizer, mlm=False),
+        data_collator=DataCollatorForSeq2Seq(tokenizer, model=model, padding="longest", pad_to_multiple_of=8),
     )
     trainer.train()
 
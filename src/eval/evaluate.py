@@ -1,37 +1,62 @@
 import argparse
 import json
+from functools import lru_cache
 from pathlib import Path
 from typing import Iterable, List
 
 import evaluate
+import numpy as np
+import orjson
 
 
 def load_json(path: Path) -> List[dict]:
-    text = path.read_text(encoding="utf-8")
-    if text.lstrip().startswith("["):
-        return json.loads(text)
-    return [json.loads(line) for line in text.splitlines() if line.strip()]
+    """Load a JSON list or JSONL file; JSONL is parsed line by line without buffering the text."""
+    with path.open("rb") as f:
+        head = f.read(1)
+        while head.isspace():
+            head = f.read(1)
+        f.seek(0)
+        if head == b"[":
+            return orjson.loads(f.read())
+        return [orjson.loads(line) for line in f if line.strip()]
+
+
+@lru_cache(maxsize=None)
+def _get_bleu():
+    return evaluate.load("sacrebleu")
+
+
+@lru_cache(maxsize=None)
+def _get_bertscore():
+    # bertscore 内部按 model_type 缓存 BERT 模型，复用同一 metric 对象即可避免重复加载
+    return evaluate.load("bertscore")
 
 
 def compute_metrics(references: Iterable[str], predictions: Iterable[str]) -> dict:
     refs = list(references)
     preds = list(predictions)
 
-    bleu = evaluate.load("sacrebleu")
-    bertscore = evaluate.load("bertscore")
+    bleu = _get_bleu()
+    bertscore = _get_bertscore()
+
+    refs_wrapped = [[r] for r in refs]
+    bleu_score = bleu.compute(predictions=preds, references=refs_wrapped)
+    import torch  # 仅在计算 BERTScore 时需要
 
-    bleu_score = bleu.compute(predictions=preds, references=[[r] for r in refs])
     bert_score = bertscore.compute(
         predictions=preds,
         references=refs,
         lang="zh",
         model_type="bert-base-chinese",
+        num_layers=8,
+        batch_size=128,
+        device="cuda" if torch.cuda.is_available() else "cpu",
     )
     return {
         "bleu": bleu_score["score"],
-        "bertscore_precision": sum(bert_score["precision"]) / len(preds),
-        "bertscore_recall": sum(bert_score["recall"]) / len(preds),
-        "bertscore_f1": sum(bert_score["f1"]) / len(preds),
+        "bertscore_precision": float(np.mean(bert_score["precision"], dtype=np.float64)),
+        "bertscore_recall": float(np.mean(bert_score["recall"], dtype=np.float64)),
+        "bertscore_f1": float(np.mean(bert_score["f1"], dtype=np.float64)),
     }
 
 
@@ -45,12 +70,9 @@ def main() -> None:
     student = load_json(args.student)
 
     # assume same ordering by id
-    teacher_by_id = {item["id"]: item for item in teacher}
-    preds, refs = [], []
-    for sample in student:
-        ref = teacher_by_id.get(sample["id"], {})
-        refs.append(ref.get("output", ""))
-        preds.append(sample.get("output", ""))
+    teacher_out = {item["id"]: item.get("output", "") for item in teacher}
+    refs = [teacher_out.get(sample["id"], "") for sample in student]
+    preds = [sample.get("output", "") for sample in student]
 
     metrics = compute_metrics(references=refs, predictions=preds)
     print(json.dumps(metrics, ensure_ascii=False, indent=2))
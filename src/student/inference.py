@@ -1,26 +1,215 @@
 import argparse
+import importlib.util
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence, Union
 
-from peft import PeftModel
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+import numpy as np
+import torch
+from peft import MODEL_TYPE_TO_PEFT_MODEL_MAPPING, PeftConfig, PeftModel, set_peft_model_state_dict
+from safetensors import safe_open
+from transformers import AutoModelForCausalLM, AutoTokenizer
 
 
-def load_student(base_model: str, lora_path: Path):
-    tokenizer = AutoTokenizer.from_pretrained(base_model)
-    base = AutoModelForCausalLM.from_pretrained(base_model)
-    model = PeftModel.from_pretrained(base, lora_path)
+DEFAULT_ADAPTER = "default"
+# TORCH_COMPILE=1 时编译解码前向并使用静态 KV cache；prompt 长度按桶对齐以复用编译图
+TORCH_COMPILE = os.getenv("TORCH_COMPILE") == "1"
+PROMPT_PAD_MULTIPLE = 64
+
+
+def _inference_dtype() -> torch.dtype:
+    if not torch.cuda.is_available():
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
+def attn_implementation(dtype: torch.dtype) -> str:
+    """FlashAttention-2 on CUDA with half-precision weights when installed, fused SDPA otherwise."""
+    if (
+        torch.cuda.is_available()
+        and dtype in (torch.float16, torch.bfloat16)
+        and importlib.util.find_spec("flash_attn") is not None
+    ):
+        return "flash_attention_2"
+    return "sdpa"
+
+
+def _prepare_tokenizer(tokenizer) -> None:
+    # 批量生成需要左侧 padding；只在加载时配置一次，而不是每次生成都改
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+
+
+def _read_adapter_weights(lora_path: Path) -> Optional[Dict[str, torch.Tensor]]:
+    weights = Path(lora_path) / "adapter_model.safetensors"
+    if not weights.exists():
+        return None
+    with safe_open(str(weights), framework="pt", device="cpu") as f:
+        return {key: f.get_tensor(key) for key in f.keys()}
+
+
+def _attach_adapter(model, name: str, lora_path: Path, state_dict: Optional[Dict[str, torch.Tensor]]) -> PeftModel:
+    """Add adapter ``name`` to ``model`` (a base model or PeftModel) from already-read weights."""
+    if state_dict is None:
+        # 非 safetensors 格式的旧权重，交给 PEFT 自己读盘
+        if isinstance(model, PeftModel):
+            model.load_adapter(str(lora_path), adapter_name=name)
+            return model
+        return PeftModel.from_pretrained(model, lora_path, adapter_name=name)
+    config = PeftConfig.from_pretrained(str(lora_path))
+    config.inference_mode = True
+    if isinstance(model, PeftModel):
+        model.add_adapter(name, config)
+    else:
+        # 与 PeftModel.from_pretrained 一致按 task_type 选子类（CAUSAL_LM -> PeftModelForCausalLM）
+        peft_cls = MODEL_TYPE_TO_PEFT_MODEL_MAPPING.get(config.task_type, PeftModel)
+        model = peft_cls(model, config, adapter_name=name)
+    load_result = set_peft_model_state_dict(model, state_dict, adapter_name=name)
+    # strict=False 加载时基座权重都算 missing，只检查属于本 adapter 的键
+    missing = [key for key in load_result.missing_keys if f".{name}." in key]
+    if missing or load_result.unexpected_keys:
+        warnings.warn(
+            f"LoRA adapter '{name}' from {lora_path}: {len(missing)} missing keys (e.g. {missing[:3]}), "
+            f"{len(load_result.unexpected_keys)} unexpected keys (e.g. {load_result.unexpected_keys[:3]})"
+        )
+    return model
+
+
+def load_student(
+    base_model: str,
+    lora_paths: Union[Path, Mapping[str, Path]],
+    active: Optional[str] = None,
+):
+    """Load the base model once and preload every LoRA adapter into a single PeftModel.
+
+    ``lora_paths`` may be a single path (registered as ``"default"``) or a mapping of
+    adapter name -> path; ``active`` picks the adapter enabled after loading.
+    """
+    if not isinstance(lora_paths, Mapping):
+        lora_paths = {DEFAULT_ADAPTER: Path(lora_paths)}
+    if not lora_paths:
+        raise ValueError("lora_paths must contain at least one adapter")
+    active = active or next(iter(lora_paths))
+    if active not in lora_paths:
+        raise KeyError(f"Unknown adapter {active!r}; available: {list(lora_paths)}")
+
+    # 基座模型加载的同时，后台线程先把 LoRA 权重读进内存，二者的磁盘 IO 互相重叠
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        prefetched = {name: pool.submit(_read_adapter_weights, path) for name, path in lora_paths.items()}
+        tokenizer = AutoTokenizer.from_pretrained(base_model)
+        _prepare_tokenizer(tokenizer)
+        dtype = _inference_dtype()
+        model = AutoModelForCausalLM.from_pretrained(
+            base_model,
+            torch_dtype=dtype,
+            device_map="auto",
+            attn_implementation=attn_implementation(dtype),
+        )
+        for name in [active] + [n for n in lora_paths if n != active]:
+            model = _attach_adapter(model, name, lora_paths[name], prefetched[name].result())
+    model.set_adapter(active)
+    model.eval()
+    if TORCH_COMPILE:
+        # 编译底层模型的 forward（generate 调用的是它），LoRA 层包含在内
+        inner = model.get_base_model()
+        inner.forward = torch.compile(inner.forward, mode="reduce-overhead", fullgraph=False)
+        # 预热一次，首个真实请求不再承担编译开销
+        generate_batch(tokenizer, model, ["什么是资本成本？"])
     return tokenizer, model
 
 
-def chat(tokenizer, model, question: str, max_new_tokens: int = 256) -> str:
-    generator = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-    )
-    prompt = f"用户问题：{question}\n请像 CPA 老师一样回答："
-    outputs = generator(prompt, max_new_tokens=max_new_tokens, do_sample=True, temperature=0.7)
-    return outputs[0]["generated_text"][len(prompt) :].strip()
+def preload_loras(model: PeftModel, lora_paths: Mapping[str, Path]) -> None:
+    """Load extra adapters next to the active one so switching is a pointer swap."""
+    for name, path in lora_paths.items():
+        if name in model.peft_config:
+            continue
+        model.load_adapter(str(path), adapter_name=name)
+
+
+def switch_lora(model: PeftModel, name: str) -> None:
+    if name not in model.peft_config:
+        raise KeyError(f"Adapter {name!r} is not preloaded; available: {list_preloaded_loras(model)}")
+    model.set_adapter(name)
+
+
+def list_preloaded_loras(model: PeftModel) -> List[str]:
+    return list(model.peft_config.keys())
+
+
+def build_prompt(question: str) -> str:
+    return f"用户问题：{question}\n请像 CPA 老师一样回答："
+
+
+def length_buckets(lengths: Sequence[int], batch_size: int) -> List[np.ndarray]:
+    """Group sample indices into batches of similar token length (shortest first)."""
+    order = np.argsort(np.asarray(lengths, dtype=np.int64), kind="stable")
+    return [order[start : start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def generate_batch(
+    tokenizer,
+    model,
+    questions: Sequence[str],
+    max_new_tokens: int = 256,
+    batch_size: int = 16,
+    do_sample: bool = False,
+    temperature: float = 0.7,
+    **generate_kwargs,
+) -> List[str]:
+    """Answer many questions with left-padded, length-sorted ``model.generate`` batches."""
+    if tokenizer.pad_token is None or tokenizer.padding_side != "left":
+        # 非 load_student 加载的 tokenizer
+        _prepare_tokenizer(tokenizer)
+
+    # 一次性分词拿到真实 token 长度，按长度分桶以减少同批内的 padding 浪费
+    input_ids = tokenizer([build_prompt(q) for q in questions])["input_ids"]
+    # 贪心解码（num_beams=1, do_sample=False）结果可复现，且每步只需 argmax
+    generate_kwargs = {"do_sample": do_sample, "num_beams": 1, "use_cache": True, **generate_kwargs}
+    if do_sample:
+        generate_kwargs["temperature"] = temperature
+    pad_kwargs = {}
+    if TORCH_COMPILE:
+        generate_kwargs.setdefault("cache_implementation", "static")
+        pad_kwargs["pad_to_multiple_of"] = PROMPT_PAD_MULTIPLE
+    answers: List[str] = [""] * len(input_ids)
+    for batch_ids in length_buckets([len(ids) for ids in input_ids], batch_size):
+        enc = tokenizer.pad(
+            {"input_ids": [input_ids[i] for i in batch_ids]},
+            padding=True,
+            return_tensors="pt",
+            **pad_kwargs,
+        ).to(model.device)
+        outputs = model.generate(
+            **enc,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.pad_token_id,
+            **generate_kwargs,
+        )
+        new_tokens = outputs[:, enc["input_ids"].shape[1] :]
+        for i, text in zip(batch_ids.tolist(), tokenizer.batch_decode(new_tokens, skip_special_tokens=True)):
+            answers[i] = text.strip()
+    return answers
+
+
+def chat(
+    tokenizer,
+    model,
+    question: str,
+    max_new_tokens: int = 256,
+    do_sample: bool = False,
+    temperature: float = 0.7,
+) -> str:
+    return generate_batch(
+        tokenizer,
+        model,
+        [question],
+        max_new_tokens=max_new_tokens,
+        do_sample=do_sample,
+        temperature=temperature,
+    )[0]
 
 
 def main() -> None:
@@ -1,42 +1,279 @@
+import asyncio
+import inspect
+import itertools
 import json
 import os
+import re
+import time
+import weakref
 from dataclasses import dataclass
-from typing import List, Optional, Sequence
+from functools import lru_cache
+from typing import Any, Iterable, List, Optional, Sequence
 
+import httpx
+import msgspec
+import openai
+from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+from tenacity import AsyncRetrying, Retrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from .cache import LLMCache, TokenUsageStats
+from .dedup import SemanticDeduper
 
 
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+# 分层模型：easy/medium 出题与评审走 FAST，hard 出题走 STRONG；未设置时都回落到 DEEPSEEK_MODEL
+DEEPSEEK_FAST_MODEL = os.getenv("DEEPSEEK_FAST_MODEL", DEEPSEEK_MODEL)
+DEEPSEEK_STRONG_MODEL = os.getenv("DEEPSEEK_STRONG_MODEL", DEEPSEEK_MODEL)
 DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
+# 所有 Agent 共享的响应缓存；设置 LLM_CACHE_DIR 可持久化到 sqlite
+LLM_CACHE = LLMCache.from_env()
+# 按模型统计 token 花费，以及 DeepSeek 服务端前缀缓存的命中（系统提示保持为稳定前缀才能命中）
+TOKEN_USAGE = TokenUsageStats()
 
-def _build_client(temperature: float = 0.2) -> Optional[ChatOpenAI]:
-    """Instantiate a ChatOpenAI client if credentials are available."""
-    if not DEEPSEEK_API_KEY or not DEEPSEEK_API_BASE:
-        return None
+
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+
+@lru_cache(maxsize=None)
+def _http_client() -> httpx.Client:
+    """Process-wide sync connection pool so every agent reuses the same keep-alive sockets."""
+    return httpx.Client(limits=_HTTP_LIMITS, timeout=120)
+
+
+# 异步连接池绑定创建它的事件循环，不能跨 asyncio.run / Streamlit 线程复用：
+# 按运行中的事件循环各建一份 (AsyncClient, {(temperature, model): ChatOpenAI})
+_LOOP_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, dict]]" = (
+    weakref.WeakKeyDictionary()
+)
+# _build_client 产出的客户端 -> (temperature, model)，用于找到当前事件循环里的同配置客户端
+_CLIENT_PARAMS: dict[int, tuple[float, Optional[str]]] = {}
+
+
+def _chat_client(
+    temperature: float, model: Optional[str], http_async_client: Optional[httpx.AsyncClient] = None
+) -> ChatOpenAI:
     return ChatOpenAI(
-        model=DEEPSEEK_MODEL,
+        model=model or DEEPSEEK_MODEL,
         temperature=temperature,
         api_key=DEEPSEEK_API_KEY,
         base_url=DEEPSEEK_API_BASE,
+        http_client=_http_client(),
+        http_async_client=http_async_client,
+        stream_usage=True,
+        # 单次请求 30s 超时；SDK 不再自行重试，重试统一由 _retrying / DatasetSynthesizer 的限流器负责，
+        # 否则两层重试相乘（429 时 SDK 先重试，限流器反应滞后）
+        timeout=30,
+        max_retries=0,
     )
 
 
+@lru_cache(maxsize=8)
+def _build_client(temperature: float = 0.2, model: Optional[str] = None) -> Optional[ChatOpenAI]:
+    """Instantiate (once per temperature/model) a ChatOpenAI client if credentials are available.
+
+    The returned client is used for sync calls; async calls go through :func:`_loop_client`.
+    """
+    if not DEEPSEEK_API_KEY or not DEEPSEEK_API_BASE:
+        return None
+    client = _chat_client(temperature, model)
+    _CLIENT_PARAMS[id(client)] = (temperature, model)
+    return client
+
+
+def _loop_client(client: ChatOpenAI) -> ChatOpenAI:
+    """Counterpart of ``client`` whose async connection pool belongs to the running event loop."""
+    params = _CLIENT_PARAMS.get(id(client))
+    if params is None:
+        # 调用方自己传入的客户端原样使用
+        return client
+    loop = asyncio.get_running_loop()
+    if loop not in _LOOP_CLIENTS:
+        _LOOP_CLIENTS[loop] = (httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=120), {})
+    http_async_client, clients = _LOOP_CLIENTS[loop]
+    if params not in clients:
+        clients[params] = _chat_client(*params, http_async_client=http_async_client)
+    return clients[params]
+
+
+async def _close_loop_clients() -> None:
+    """Close the running loop's async connection pool before the loop itself shuts down."""
+    entry = _LOOP_CLIENTS.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        await entry[0].aclose()
+
+
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*(.*?)\s*(?:```)?$", re.DOTALL | re.IGNORECASE)
+
+
+def _strip_code_fence(content: str) -> str:
+    cleaned = content.strip()
+    match = _CODE_FENCE.match(cleaned)
+    return match.group(1) if match else cleaned
+
+
+def _parse_json_stream(chunks: Iterable[str]) -> tuple[Any, str]:
+    """Collect streamed chunks into a list and parse JSON once, after the stream ends.
+
+    Returns ``(data, text)``; ``data`` is None when the text is not complete, valid JSON.
+    """
+    parts: list[str] = []
+    for chunk in chunks:
+        if chunk:
+            parts.append(chunk)
+    text = "".join(parts).strip()
+    cleaned = _strip_code_fence(text)
+    # 结尾不是 } 或 ] 的必然不完整，省掉一次注定失败的 json.loads
+    if cleaned[-1:] not in ("}", "]"):
+        return None, text
+    try:
+        return json.loads(cleaned), text
+    except ValueError:
+        return None, text
+
+
+# 一次扫描拆出 "问题：...\n答案：..."，兼容 问/答 简写与全角/半角冒号；
+# 答案标签必须位于行首，题干里的 "请简要回答：" 之类不会被误当成分隔符
+_QA_SPLIT = re.compile(r"^\s*(?:问(?:题)?[:：])?\s*(.*?)\s*\n\s*答(?:案)?[:：]\s*(.*)$", re.DOTALL)
+# 单行回复（"问题：... 答案：..." / "问：... 答：..."）：简写 "答" 前必须是空白或标点，
+# 这样 "回答：" 不会被拆开
+_QA_SPLIT_INLINE = re.compile(
+    r"^\s*(?:问(?:题)?[:：])?\s*(.*?)\s*(?:答案|(?<=[\s，。？！；,.?!;])答)[:：]\s*(.*)$", re.DOTALL
+)
+
+
+def _canonical_question(question: str) -> str:
+    """Dedup key for near-identical questions: drop whitespace/punctuation, keep a 40-char prefix."""
+    return re.sub(r"[\W_]+", "", question).lower()[:40]
+
+
+# 超时/连接错误在调用层带抖动重试；异步路径的 429 不在此重试，交给 DatasetSynthesizer 降并发
+_TRANSIENT_ERRORS = (openai.APIConnectionError, httpx.TransportError)
+RATE_LIMIT_RETRIES = 5
+_RETRY_POLICY = dict(stop=stop_after_attempt(3), wait=wait_random_exponential(multiplier=0.5, max=8), reraise=True)
+
+
+def _retrying() -> AsyncRetrying:
+    return AsyncRetrying(retry=retry_if_exception_type(_TRANSIENT_ERRORS), **_RETRY_POLICY)
+
+
+def _sync_retrying() -> Retrying:
+    # 同步调用（规划、App 单题问答）没有限流器，429 也在这里退避重试
+    return Retrying(retry=retry_if_exception_type((*_TRANSIENT_ERRORS, openai.RateLimitError)), **_RETRY_POLICY)
+
+
+def _retry_after(exc: openai.RateLimitError, default: float = 2.0) -> float:
+    try:
+        return float(exc.response.headers.get("retry-after", default))
+    except (AttributeError, ValueError):
+        return default
+
+
+class _AdaptiveLimiter:
+    """Concurrency gate that halves its limit on rate limits and restores it after a cool-down."""
+
+    def __init__(self, limit: int, cooldown: float = 30.0) -> None:
+        self.max_limit = self.limit = limit
+        self.active = 0
+        self.cooldown = cooldown
+        self._restore_at = 0.0
+        self._cond = asyncio.Condition()
+
+    def _ready(self) -> bool:
+        if self.limit < self.max_limit and time.monotonic() >= self._restore_at:
+            self.limit = self.max_limit
+        return self.active < self.limit
+
+    def backoff(self) -> None:
+        # 同一波并发的 429 只减半一次，冷却期内的后续 429 不再叠加
+        if time.monotonic() < self._restore_at:
+            return
+        self.limit = max(1, self.limit // 2)
+        self._restore_at = time.monotonic() + self.cooldown
+
+    async def __aenter__(self) -> None:
+        async with self._cond:
+            await self._cond.wait_for(self._ready)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info) -> None:
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
 def _fallback_response(prompt: str, tag: str) -> str:
     """Offline-safe fallback message used when API credentials are missing."""
     return f"[{tag}] {prompt[:120]} ... (请配置 DEEPSEEK_API_KEY 和 DEEPSEEK_API_BASE 以获得真实生成内容)"
 
 
+class _CachedLLMAgent:
+    """Routes client calls through the shared exact-match :class:`LLMCache`."""
+
+    client: Optional[ChatOpenAI]
+    cache: LLMCache
+
+    @staticmethod
+    def _model_name(client: Optional[ChatOpenAI]) -> str:
+        return getattr(client, "model_name", DEEPSEEK_MODEL)
+
+    def _cache_key(
+        self, rendered: Sequence[BaseMessage], tag: str = "", client: Optional[ChatOpenAI] = None
+    ) -> str:
+        client = client or self.client
+        model = self._model_name(client)
+        prompt = [(message.type, message.content) for message in rendered]
+        return self.cache.make_key(model, getattr(client, "temperature", None), prompt, tag)
+
+    def _cached_invoke(self, rendered: Sequence[BaseMessage], client: Optional[ChatOpenAI] = None) -> str:
+        client = client or self.client
+        key = self._cache_key(rendered, client=client)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        for attempt in _sync_retrying():
+            with attempt:
+                response = client.invoke(rendered)
+        TOKEN_USAGE.record(response, self._model_name(client))
+        content = response.content.strip()
+        self.cache.set(key, content)
+        return content
+
+    def _stream_contents(self, rendered: Sequence[BaseMessage]) -> List[str]:
+        # 整段流读完才算一次成功的尝试，重试时不会把半截内容重复交给解析
+        for attempt in _sync_retrying():
+            with attempt:
+                parts = []
+                for chunk in self.client.stream(rendered):
+                    TOKEN_USAGE.record(chunk, self._model_name(self.client))
+                    parts.append(chunk.content)
+        return parts
+
+    async def _cached_ainvoke(self, rendered: Sequence[BaseMessage], client: Optional[ChatOpenAI] = None) -> str:
+        client = client or self.client
+        key = self._cache_key(rendered, client=client)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        async for attempt in _retrying():
+            with attempt:
+                response = await _loop_client(client).ainvoke(rendered)
+        TOKEN_USAGE.record(response, self._model_name(client))
+        content = response.content.strip()
+        self.cache.set(key, content)
+        return content
+
+
 @dataclass
 class OutlineNode:
     section: str
     bullet_points: List[str]
 
 
-@dataclass
-class QAItem:
+class QAItem(msgspec.Struct):
     id: int
     topic: str
     difficulty: str
@@ -47,150 +284,350 @@ class QAItem:
     score: Optional[float] = None
 
 
-class PlannerAgent:
+# 提示模板在导入时编译一次，各 Agent 实例共享，服务端每次请求新建 Agent 也不再重复解析
+_PLANNER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "你是注册会计师课程的教案设计师，请输出章节大纲，每节给出 2-4 个要点，使用 JSON 数组，每项含 section 和 bullet_points。",
+        ),
+        ("human", "科目: {topic}"),
+    ]
+)
+
+
+class PlannerAgent(_CachedLLMAgent):
     """Breaks a topic into teachable outline nodes."""
 
-    def __init__(self, client: Optional[ChatOpenAI] = None) -> None:
+    def __init__(self, client: Optional[ChatOpenAI] = None, cache: Optional[LLMCache] = None) -> None:
         self.client = client or _build_client()
-        self.prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    "你是注册会计师课程的教案设计师，请输出章节大纲，每节给出 2-4 个要点，使用 JSON 数组，每项含 section 和 bullet_points。",
-                ),
-                ("human", "科目: {topic}"),
-            ]
-        )
+        self.cache = cache or LLM_CACHE
+        self.prompt = _PLANNER_PROMPT
 
     def plan(self, topic: str) -> List[OutlineNode]:
-        rendered = self.prompt.format(topic=topic)
+        # 无凭据时直接返回占位内容，跳过模板渲染
         if not self.client:
-            fallback = _fallback_response(rendered, "Planner")
+            fallback = _fallback_response(f"科目: {topic}", "Planner")
             return [OutlineNode(section=topic, bullet_points=[fallback])]
-        response = self.client.invoke(rendered)
-        content = response.content.strip()
+        rendered = self.prompt.format_messages(topic=topic)
+        key = self._cache_key(rendered)
+        cached = self.cache.get(key)
+        data, content = _parse_json_stream([cached] if cached is not None else self._stream_contents(rendered))
         try:
-            data = json.loads(content)
-            return [OutlineNode(**item) for item in data]
+            outline = [OutlineNode(**item) for item in data]
         except Exception:
+            # 解析失败的回复不入缓存，否则落盘后每次重跑都只能拿到兜底大纲
             return [OutlineNode(section=topic, bullet_points=[content])]
-
-
-class WriterAgent:
+        if cached is None:
+            self.cache.set(key, content)
+        return outline
+
+
+_QA_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "你是 CPA 讲解老师，输出简短单轮 QA：\n- 题型：填空/计算/简答，题干<=30字，答案<=40字，可含1条公式或1-2步计算；\n- 只出一问一答，不要解析/点评/多问多答；\n- 题干紧扣给定要点，不扩展新话题；\n- 输出格式严格为：问题：...\\n答案：...",
+        ),
+        (
+            "human",
+            "科目: {topic}\n要点: {bullets}\n难度: {difficulty}\n变体序号: {variant}",
+        ),
+    ]
+)
+
+_NOTE_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "用 80-120 字写 CPA 知识点讲解，突出公式/定义，避免冗长案例。",
+        ),
+        (
+            "human",
+            "标题: {heading}\n要点: {bullets}\n请输出讲解。",
+        ),
+    ]
+)
+
+_ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "你是 CPA 教学专家，回答要简短、有条理，避免长段落。",
+        ),
+        ("human", "问题: {question}"),
+    ]
+)
+
+
+class WriterAgent(_CachedLLMAgent):
     """Produces teaching notes or QA pairs for outline nodes."""
 
-    def __init__(self, client: Optional[ChatOpenAI] = None) -> None:
-        self.client = client or _build_client(temperature=0.7)
-        self.qa_prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    "你是 CPA 讲解老师，输出简短单轮 QA：\n- 题型：填空/计算/简答，题干<=30字，答案<=40字，可含1条公式或1-2步计算；\n- 只出一问一答，不要解析/点评/多问多答；\n- 题干紧扣给定要点，不扩展新话题；\n- 输出格式严格为：问题：...\\n答案：...",
-                ),
-                (
-                    "human",
-                    "科目: {topic}\n要点: {bullets}\n难度: {difficulty}\n变体序号: {variant}",
-                ),
-            ]
-        )
-        self.note_prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    "用 80-120 字写 CPA 知识点讲解，突出公式/定义，避免冗长案例。",
-                ),
-                (
-                    "human",
-                    "标题: {heading}\n要点: {bullets}\n请输出讲解。",
-                ),
-            ]
+    # 超过这个变体序号后，若回复与同一要点/难度之前出过的题重复，就改写提示并升温重出一次
+    NOVELTY_AFTER_VARIANT = 3
+
+    def __init__(
+        self,
+        client: Optional[ChatOpenAI] = None,
+        cache: Optional[LLMCache] = None,
+        novelty_client: Optional[ChatOpenAI] = None,
+        fast_client: Optional[ChatOpenAI] = None,
+        fast_novelty_client: Optional[ChatOpenAI] = None,
+    ) -> None:
+        self.client = client or _build_client(temperature=0.7, model=DEEPSEEK_STRONG_MODEL)
+        self.novelty_client = novelty_client or (
+            _build_client(temperature=1.0, model=DEEPSEEK_STRONG_MODEL) if client is None else client
         )
-        self.answer_prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    "你是 CPA 教学专家，回答要简短、有条理，避免长段落。",
-                ),
-                ("human", "问题: {question}"),
-            ]
+        fast_client = fast_client or (_build_client(temperature=0.7, model=DEEPSEEK_FAST_MODEL) if client is None else client)
+        fast_novelty_client = fast_novelty_client or (
+            _build_client(temperature=1.0, model=DEEPSEEK_FAST_MODEL) if client is None else client
         )
+        # 按难度路由：easy/medium 用便宜快速的模型，hard 留给主力模型；高温改写同样按难度分层
+        self.clients = {"easy": fast_client, "medium": fast_client, "hard": self.client}
+        self.novelty_clients = {"easy": fast_novelty_client, "medium": fast_novelty_client, "hard": self.novelty_client}
+        self.cache = cache or LLM_CACHE
+        # (topic, bullets, difficulty, variant) -> 解析后的 (问题, 答案)，同一输入不再重复请求和解析
+        self._qa_cache: dict[tuple, tuple[str, str]] = {}
+        # (topic, bullets, difficulty) -> 已出过题目的规范化前缀，用来判断新回复是否真的重复
+        self._produced: dict[tuple, set[str]] = {}
+        self.qa_prompt = _QA_PROMPT
+        self.note_prompt = _NOTE_PROMPT
+        self.answer_prompt = _ANSWER_PROMPT
 
     def generate_note(self, heading: str, bullets: Sequence[str]) -> str:
-        rendered = self.note_prompt.format(heading=heading, bullets="; ".join(bullets))
         if not self.client:
-            return _fallback_response(rendered, "TeachingNote")
-        return self.client.invoke(rendered).content.strip()
+            return _fallback_response(f"标题: {heading}", "TeachingNote")
+        rendered = self.note_prompt.format_messages(heading=heading, bullets="; ".join(bullets))
+        return self._cached_invoke(rendered)
+
+    async def agenerate_note(self, heading: str, bullets: Sequence[str]) -> str:
+        if not self.client:
+            return _fallback_response(f"标题: {heading}", "TeachingNote")
+        rendered = self.note_prompt.format_messages(heading=heading, bullets="; ".join(bullets))
+        return await self._cached_ainvoke(rendered)
+
+    def _qa_request(
+        self, topic: str, bullets: Sequence[str], difficulty: str, variant: int, rephrase: bool = False
+    ) -> tuple[List[BaseMessage], Optional[ChatOpenAI]]:
+        joined = "; ".join(bullets)
+        client = self.clients.get(difficulty, self.client)
+        if rephrase:
+            # 改写要点并用高温客户端，避免与前几个变体撞题
+            joined = f"请从另一个角度提问：{joined}"
+            client = self.novelty_clients.get(difficulty, self.novelty_client)
+        rendered = self.qa_prompt.format_messages(topic=topic, bullets=joined, difficulty=difficulty, variant=variant)
+        return rendered, client
+
+    def _is_repeat(self, key: tuple, question: str) -> bool:
+        """Record ``question`` under its (topic, bullets, difficulty) and report whether it was seen."""
+        produced = self._produced.setdefault(key[:3], set())
+        canonical = _canonical_question(question)
+        if canonical in produced:
+            return True
+        produced.add(canonical)
+        return False
 
     def generate_qa(
         self, topic: str, bullets: Sequence[str], difficulty: str, variant: int = 1
     ) -> tuple[str, str]:
-        rendered = self.qa_prompt.format(
-            topic=topic,
-            bullets="; ".join(bullets),
-            difficulty=difficulty,
-            variant=variant,
-        )
         if not self.client:
-            placeholder = _fallback_response(rendered, "QA")
+            # 难度/变体序号放在占位内容开头，离线运行时前缀去重也不会把各样本判为重复
+            placeholder = _fallback_response(f"{difficulty} #{variant} {'; '.join(bullets)} {topic}", "QA")
             return placeholder, placeholder
-        reply = self.client.invoke(rendered).content.strip()
-        if "答案：" in reply:
-            parts = reply.split("答案：", maxsplit=1)
-            return parts[0].replace("问题：", "").strip(), parts[1].strip()
-        if "答：" in reply:
-            parts = reply.split("答：", maxsplit=1)
-            return parts[0].replace("问：", "").strip(), parts[1].strip()
-        return reply, ""
-
-    def answer_question(self, question: str) -> str:
-        rendered = self.answer_prompt.format(question=question)
+        key = (topic, tuple(bullets), difficulty, variant)
+        if key in self._qa_cache:
+            return self._qa_cache[key]
+        rendered, client = self._qa_request(topic, bullets, difficulty, variant)
+        result = self._parse_qa(self._cached_invoke(rendered, client))
+        # 每条回复都登记；只有高变体序号且真的撞题时才改写重出
+        if self._is_repeat(key, result[0]) and variant > self.NOVELTY_AFTER_VARIANT:
+            rendered, client = self._qa_request(topic, bullets, difficulty, variant, rephrase=True)
+            result = self._parse_qa(self._cached_invoke(rendered, client))
+            self._is_repeat(key, result[0])
+        self._qa_cache[key] = result
+        return result
+
+    async def agenerate_qa(
+        self, topic: str, bullets: Sequence[str], difficulty: str, variant: int = 1
+    ) -> tuple[str, str]:
         if not self.client:
-            return _fallback_response(rendered, "TeacherAnswer")
-        return self.client.invoke(rendered).content.strip()
+            # 难度/变体序号放在占位内容开头，离线运行时前缀去重也不会把各样本判为重复
+            placeholder = _fallback_response(f"{difficulty} #{variant} {'; '.join(bullets)} {topic}", "QA")
+            return placeholder, placeholder
+        key = (topic, tuple(bullets), difficulty, variant)
+        if key in self._qa_cache:
+            return self._qa_cache[key]
+        rendered, client = self._qa_request(topic, bullets, difficulty, variant)
+        result = self._parse_qa(await self._cached_ainvoke(rendered, client))
+        # 每条回复都登记；只有高变体序号且真的撞题时才改写重出
+        if self._is_repeat(key, result[0]) and variant > self.NOVELTY_AFTER_VARIANT:
+            rendered, client = self._qa_request(topic, bullets, difficulty, variant, rephrase=True)
+            result = self._parse_qa(await self._cached_ainvoke(rendered, client))
+            self._is_repeat(key, result[0])
+        self._qa_cache[key] = result
+        return result
 
+    @staticmethod
+    def _parse_qa(reply: str) -> tuple[str, str]:
+        match = _QA_SPLIT.match(reply) or _QA_SPLIT_INLINE.match(reply)
+        return (match.group(1), match.group(2).strip()) if match else (reply, "")
 
-class ReviewerAgent:
+    def answer_question(self, question: str) -> str:
+        if not self.client:
+            return _fallback_response(f"问题: {question}", "TeacherAnswer")
+        rendered = self.answer_prompt.format_messages(question=question)
+        return self._cached_invoke(rendered)
+
+
+_REVIEW_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "你是注册会计师出题质检专家，只返回 JSON，不要代码块，不要多余文字。键：score(0-10), review(20字内指出是否贴合要点、是否简洁)。",
+        ),
+        (
+            "human",
+            "问题: {question}\n答案: {answer}\n请直接输出 JSON，例如 {{\"score\": 8.5, \"review\": \"答案简短但缺少公式\"}}",
+        ),
+    ]
+)
+
+_REVIEW_BATCH_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "你是注册会计师出题质检专家，只返回 JSON 数组，不要代码块，不要多余文字。每项键：id(原样返回), score(0-10), review(20字内指出是否贴合要点、是否简洁)。",
+        ),
+        (
+            "human",
+            "请对以下 {n} 条问答评分并输出 JSON 数组[{{\"id\": ..., \"score\": ..., \"review\": ...}}]：\n{payload}",
+        ),
+    ]
+)
+
+
+class ReviewerAgent(_CachedLLMAgent):
     """Scores QA quality and suggests fixes."""
 
-    def __init__(self, client: Optional[ChatOpenAI] = None) -> None:
-        self.client = client or _build_client()
-        self.prompt = ChatPromptTemplate.from_messages(
-            [
-                (
-                    "system",
-                    "你是注册会计师出题质检专家，只返回 JSON，不要代码块，不要多余文字。键：score(0-10), review(20字内指出是否贴合要点、是否简洁)。",
-                ),
-                (
-                    "human",
-                    "问题: {question}\n答案: {answer}\n请直接输出 JSON，例如 {{\"score\": 8.5, \"review\": \"答案简短但缺少公式\"}}",
-                ),
-            ]
-        )
+    def __init__(self, client: Optional[ChatOpenAI] = None, cache: Optional[LLMCache] = None) -> None:
+        # 打分是简单任务，固定走 FAST 模型
+        self.client = client or _build_client(model=DEEPSEEK_FAST_MODEL)
+        self.cache = cache or LLM_CACHE
+        self.prompt = _REVIEW_PROMPT
+        self.batch_prompt = _REVIEW_BATCH_PROMPT
 
     def review(self, question: str, answer: str) -> tuple[float, str]:
-        rendered = self.prompt.format(question=question, answer=answer)
         if not self.client:
-            return 5.0, _fallback_response(rendered, "Review")
-        content = self.client.invoke(rendered).content.strip()
-        cleaned = content.strip()
-        if cleaned.startswith("```"):
-            cleaned = cleaned.strip("`").strip()
-            if cleaned.lower().startswith("json"):
-                cleaned = cleaned[4:].strip()
+            return 5.0, _fallback_response(f"问题: {question}", "Review")
+        rendered = self.prompt.format_messages(question=question, answer=answer)
+        # 直接缓存解析后的 (score, review)，命中时连解析都省掉
+        key = self._cache_key(rendered, tag="review")
+        cached = self.cache.get(key)
+        if cached is not None:
+            return float(cached[0]), cached[1]
+        data, content = _parse_json_stream(self._stream_contents(rendered))
+        return self._store_review(key, self._parse_review(data), content)
+
+    async def areview(self, question: str, answer: str) -> tuple[float, str]:
+        if not self.client:
+            return 5.0, _fallback_response(f"问题: {question}", "Review")
+        rendered = self.prompt.format_messages(question=question, answer=answer)
+        key = self._cache_key(rendered, tag="review")
+        cached = self.cache.get(key)
+        if cached is not None:
+            return float(cached[0]), cached[1]
+        async for attempt in _retrying():
+            with attempt:
+                chunks = []
+                async for chunk in _loop_client(self.client).astream(rendered):
+                    TOKEN_USAGE.record(chunk, self._model_name(self.client))
+                    chunks.append(chunk.content)
+        data, content = _parse_json_stream(chunks)
+        return self._store_review(key, self._parse_review(data), content)
+
+    def review_batch(
+        self, items: Sequence[tuple[int, str, str]], batch_size: int = 10
+    ) -> List[tuple[float, str]]:
+        """Score ``(id, question, answer)`` items with one request per ``batch_size`` items."""
+        results: List[tuple[float, str]] = []
+        for start in range(0, len(items), batch_size):
+            chunk = items[start : start + batch_size]
+            if not self.client:
+                results.extend(self.review(question, answer) for _, question, answer in chunk)
+                continue
+            parsed = self._parse_review_batch(self._cached_invoke(self._render_batch(chunk)))
+            # 解析失败或缺少某条时逐条回退，保证每条都有评分
+            results.extend(
+                parsed[item_id] if item_id in parsed else self.review(question, answer)
+                for item_id, question, answer in chunk
+            )
+        return results
+
+    async def areview_batch(
+        self, items: Sequence[tuple[int, str, str]], batch_size: int = 10
+    ) -> List[tuple[float, str]]:
+        chunks = [items[start : start + batch_size] for start in range(0, len(items), batch_size)]
+
+        async def _chunk(chunk: Sequence[tuple[int, str, str]]) -> List[tuple[float, str]]:
+            if not self.client:
+                return [await self.areview(question, answer) for _, question, answer in chunk]
+            parsed = self._parse_review_batch(await self._cached_ainvoke(self._render_batch(chunk)))
+            fallbacks = await asyncio.gather(
+                *(self.areview(question, answer) for item_id, question, answer in chunk if item_id not in parsed)
+            )
+            fallback_iter = iter(fallbacks)
+            return [parsed[item_id] if item_id in parsed else next(fallback_iter) for item_id, _, _ in chunk]
+
+        results: List[tuple[float, str]] = []
+        for chunk_result in await asyncio.gather(*(_chunk(chunk) for chunk in chunks)):
+            results.extend(chunk_result)
+        return results
+
+    def _render_batch(self, chunk: Sequence[tuple[int, str, str]]) -> List[BaseMessage]:
+        payload = json.dumps(
+            [{"id": item_id, "question": question, "answer": answer} for item_id, question, answer in chunk],
+            ensure_ascii=False,
+        )
+        return self.batch_prompt.format_messages(n=len(chunk), payload=payload)
+
+    @staticmethod
+    def _parse_review(data: Any) -> Optional[tuple[float, str]]:
         try:
-            data = json.loads(cleaned)
             return float(data.get("score", 0)), data.get("review", "")
         except Exception:
+            return None
+
+    def _store_review(self, key: str, parsed: Optional[tuple[float, str]], content: str) -> tuple[float, str]:
+        # 只缓存解析成功的评分；格式错误的回复记 0 分但不入缓存，下次运行重新评审
+        if parsed is None:
             return 0.0, content
+        self.cache.set(key, list(parsed))
+        return parsed
+
+    @staticmethod
+    def _parse_review_batch(content: str) -> dict[int, tuple[float, str]]:
+        data, _ = _parse_json_stream([content])
+        try:
+            return {int(row["id"]): (float(row.get("score", 0)), row.get("review", "")) for row in data}
+        except Exception:
+            return {}
 
 
 class DatasetSynthesizer:
     """High-level orchestrator building a list of QAItem objects."""
 
-    def __init__(self, planner: PlannerAgent, writer: WriterAgent, reviewer: ReviewerAgent) -> None:
+    def __init__(
+        self,
+        planner: PlannerAgent,
+        writer: WriterAgent,
+        reviewer: ReviewerAgent,
+        deduper: Optional[SemanticDeduper] = None,
+    ) -> None:
         self.planner = planner
         self.writer = writer
         self.reviewer = reviewer
+        # 可选的嵌入语义去重；为 None 时只按规范化前缀去重
+        self.deduper = deduper
 
     def build(
         self,
@@ -203,43 +640,142 @@ class DatasetSynthesizer:
         flush_every: int | None = None,
         flush_callback: Optional[callable] = None,
         start_id: int = 1,
+        max_concurrency: int = 16,
+        review_batch_size: int = 10,
+        skip_review: bool = False,
+        keep_items: bool = True,
+    ) -> List[QAItem]:
+        """Synchronous wrapper around :meth:`abuild` for scripts and the Streamlit app."""
+
+        async def _run() -> List[QAItem]:
+            try:
+                return await self.abuild(
+                    topic=topic,
+                    num_questions=num_questions,
+                    difficulties=difficulties,
+                    min_score=min_score,
+                    max_attempts=max_attempts,
+                    use_outline=use_outline,
+                    flush_every=flush_every,
+                    flush_callback=flush_callback,
+                    start_id=start_id,
+                    max_concurrency=max_concurrency,
+                    review_batch_size=review_batch_size,
+                    skip_review=skip_review,
+                    keep_items=keep_items,
+                )
+            finally:
+                # 每次 asyncio.run 都是新事件循环，结束前关闭本循环的连接池，下次调用重新建
+                await _close_loop_clients()
+
+        return asyncio.run(_run())
+
+    async def abuild(
+        self,
+        topic: str,
+        num_questions: int = 5,
+        difficulties: Sequence[str] | None = None,
+        min_score: float | None = None,
+        max_attempts: int | None = None,
+        use_outline: bool = False,
+        flush_every: int | None = None,
+        flush_callback: Optional[callable] = None,
+        start_id: int = 1,
+        max_concurrency: int = 16,
+        review_batch_size: int = 10,
+        skip_review: bool = False,
+        keep_items: bool = True,
     ) -> List[QAItem]:
         outline = self.planner.plan(topic) if use_outline else [OutlineNode(section=topic, bullet_points=[topic])]
         difficulties = list(difficulties or ["easy", "medium", "hard"])
         attempt_cap = max_attempts or num_questions * 5
 
+        # 并发上限，与 DeepSeek 的 RPM 限制匹配；遇到 429 时减半并在 30s 后恢复（AIMD）
+        limiter = _AdaptiveLimiter(max_concurrency)
+
+        async def _limited(call, *args, **kwargs):
+            for _ in range(RATE_LIMIT_RETRIES - 1):
+                try:
+                    async with limiter:
+                        return await call(*args, **kwargs)
+                except openai.RateLimitError as exc:
+                    limiter.backoff()
+                    await asyncio.sleep(_retry_after(exc))
+            async with limiter:
+                return await call(*args, **kwargs)
+
+        async def _note(node: OutlineNode) -> str:
+            return await _limited(self.writer.agenerate_note, node.section, node.bullet_points or [node.section])
+
+        # 大纲落地后各节讲义互不依赖，一次性并发生成；跳过讲义时教学笔记留空字符串
+        notes = await asyncio.gather(*(_note(node) for node in outline)) if use_outline else [""] * len(outline)
         expanded_outline: list[tuple[str, str, str]] = []
-        for node in outline:
-            bullets = node.bullet_points or [node.section]
-            # 跳过讲义生成以加速；教学笔记留空字符串
-            note = "" if not use_outline else self.writer.generate_note(node.section, bullets)
-            for bullet in bullets:
+        for node, note in zip(outline, notes):
+            for bullet in node.bullet_points or [node.section]:
                 expanded_outline.append((node.section, note, bullet))
 
-        dataset: list[QAItem] = []
-        seen_inputs: set[str] = set()
-        chunk_buffer: list[QAItem] = []
-        attempts = 0
+        # 预先展开全部尝试槽位：(章节, 讲义, 要点, 难度, 变体序号)，循环体内不再做取模/整除
         total_slots = len(expanded_outline)
-        while len(dataset) < num_questions and attempts < attempt_cap:
-            section, note, bullet = expanded_outline[attempts % total_slots]
-            variant = attempts // total_slots + 1
-            difficulty = difficulties[attempts % len(difficulties)]
-            question, answer = self.writer.generate_qa(
+        plan = [
+            (section, note, bullet, difficulties[i % len(difficulties)], i // total_slots + 1)
+            for i, (section, note, bullet) in enumerate(itertools.islice(itertools.cycle(expanded_outline), attempt_cap))
+        ]
+        generate_qa = self.writer.agenerate_qa
+        review_batch = self.reviewer.areview_batch
+
+        async def _generate(slot: tuple[str, str, str, str, int]):
+            section, note, bullet, difficulty, variant = slot
+            question, answer = await _limited(
+                generate_qa,
                 topic=section,
                 bullets=[bullet],
                 difficulty=difficulty,
                 variant=variant,
             )
-            score, review = self.reviewer.review(question, answer)
-            attempts += 1
-            if min_score is not None and score < min_score:
-                continue
-            if question in seen_inputs:
-                continue
-            seen_inputs.add(question)
+            return section, note, difficulty, question, answer
+
+        async def _embed(texts: list[str]):
+            # 嵌入请求与生成/评审一样：瞬时错误重试，429 经 _limited 降并发
+            async for attempt in _retrying():
+                with attempt:
+                    return await deduper.embed(texts)
+
+        async def _review(batch: list[tuple[int, str, str]]):
+            return await _limited(review_batch, batch, batch_size=review_batch_size)
+
+        # 评分只用于阈值过滤；没有阈值时跳过 Reviewer，省掉一半的 API 调用
+        run_review = min_score is not None and not skip_review
+
+        dataset: list[QAItem] = []
+        seen_inputs: set[str] = set()
+        chunk_buffer: list[QAItem] = []
+        # keep_items=False 时样本只经 flush_callback 流出，内存占用保持在 O(flush_every)
+        accepted = 0
+        next_slot = 0
+        generating: set[asyncio.Task] = set()
+        reviewing: dict[asyncio.Task, list[tuple[tuple[str, str, str, str, str], Any]]] = {}
+        deduper = self.deduper
+        # 需要评审或语义去重时样本先凑批；否则生成即接收
+        buffered = run_review or deduper is not None
+        # 已去重、等待凑批评审/嵌入的样本，以及它们（含评审中的）规范化题干
+        review_buffer: list[tuple[str, str, str, str, str]] = []
+        pending_inputs: set[str] = set()
+
+        async def _flush(items: list[QAItem]) -> None:
+            # flush_callback 可以是协程函数（如 pipeline.arun 把写盘放到线程里），此时等待其完成
+            result = flush_callback(items)
+            if inspect.isawaitable(result):
+                await result
+
+        async def _accept(
+            section: str, note: str, difficulty: str, question: str, answer: str, score, review, vector=None
+        ) -> None:
+            nonlocal accepted, chunk_buffer
+            seen_inputs.add(_canonical_question(question))
+            if vector is not None:
+                deduper.add(vector)
             item = QAItem(
-                id=start_id + len(dataset),
+                id=start_id + accepted,
                 topic=section,
                 difficulty=difficulty,
                 input=question,
@@ -248,17 +784,90 @@ class DatasetSynthesizer:
                 review=review,
                 score=score,
             )
-            dataset.append(item)
+            accepted += 1
+            if keep_items:
+                dataset.append(item)
             chunk_buffer.append(item)
             if flush_every and flush_callback and len(chunk_buffer) >= flush_every:
-                flush_callback(chunk_buffer)
-                chunk_buffer = []
+                items, chunk_buffer = chunk_buffer, []
+                await _flush(items)
+
+        async def _dispatch() -> None:
+            nonlocal review_buffer
+            batch, review_buffer = review_buffer, []
+            vectors = [None] * len(batch)
+            if deduper is not None:
+                # 整批候选一次嵌入，与已接收/评审中题目语义近似（仅改写措辞）的在评审前丢弃
+                embedded = await _limited(_embed, [entry[3] for entry in batch])
+                keep = await deduper.novel(embedded)
+                for i in set(range(len(batch))) - set(keep):
+                    pending_inputs.discard(_canonical_question(batch[i][3]))
+                batch, vectors = [batch[i] for i in keep], [embedded[i] for i in keep]
+            if not run_review:
+                for entry, vector in zip(batch, vectors):
+                    pending_inputs.discard(_canonical_question(entry[3]))
+                    if accepted < num_questions:
+                        await _accept(*entry, None, None, vector)
+                return
+            if batch:
+                indexed = [(i, question, answer) for i, (_, _, _, question, answer) in enumerate(batch)]
+                handles = [deduper.hold(vector) if vector is not None else None for vector in vectors]
+                reviewing[asyncio.create_task(_review(indexed))] = list(zip(batch, handles))
+
+        try:
+            while accepted < num_questions:
+                # 生产端：在途生成数不超过并发上限与剩余缺口，按计划顺序补位
+                gap = num_questions - accepted - len(pending_inputs)
+                while next_slot < len(plan) and len(generating) < min(max_concurrency, gap):
+                    generating.add(asyncio.create_task(_generate(plan[next_slot])))
+                    next_slot += 1
+                # 缺口已被在途样本填满，或生成已耗尽时，把不足一批的样本也送去评审
+                if review_buffer and (len(review_buffer) >= gap or not generating):
+                    await _dispatch()
+                    continue
+                if not generating and not reviewing:
+                    break
+
+                # 消费端：哪个请求先完成就先处理，慢尾请求不再拖住整轮的去重与评审
+                done, _ = await asyncio.wait([*generating, *reviewing], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task in reviewing:
+                        pending = reviewing.pop(task)
+                        for (entry, handle), (score, review) in zip(pending, task.result()):
+                            pending_inputs.discard(_canonical_question(entry[3]))
+                            vector = deduper.release(handle) if handle is not None else None
+                            if accepted < num_questions and score >= min_score:
+                                await _accept(*entry, score, review, vector)
+                        continue
+                    generating.discard(task)
+                    entry = task.result()
+                    # 先去重再评审，按规范化前缀去重，近似题不再消耗评审调用
+                    key = _canonical_question(entry[3])
+                    if key in seen_inputs or key in pending_inputs:
+                        continue
+                    if not buffered:
+                        if accepted < num_questions:
+                            await _accept(*entry, None, None)
+                        continue
+                    pending_inputs.add(key)
+                    review_buffer.append(entry)
+                    if len(review_buffer) >= review_batch_size:
+                        await _dispatch()
+        finally:
+            # 凑够 num_questions 后取消仍在途的多余生成/评审请求，并释放它们占着的待评审向量
+            for task in [*generating, *reviewing]:
+                task.cancel()
+            if deduper is not None:
+                for pending in reviewing.values():
+                    for _, handle in pending:
+                        if handle is not None:
+                            deduper.release(handle)
 
         if chunk_buffer and flush_callback:
-            flush_callback(chunk_buffer)
+            await _flush(chunk_buffer)
 
         return dataset
 
     @staticmethod
     def to_jsonl(records: Sequence[QAItem]) -> str:
-        return "\n".join(json.dumps(record.__dict__, ensure_ascii=False) for record in records)
+        return b"\n".join(msgspec.json.encode(record) for record in records).decode("utf-8")
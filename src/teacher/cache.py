@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class LLMCache:
+    """Exact-match response cache keyed by sha256(model, temperature, prompt).
+
+    Entries live in memory by default; pass a directory (or set ``LLM_CACHE_DIR``)
+    to persist them in a sqlite file so reruns and retries skip the network.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._memory: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(cache_dir / "llm_cache.sqlite3"), check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._conn.commit()
+
+    @classmethod
+    def from_env(cls) -> "LLMCache":
+        cache_dir = os.getenv("LLM_CACHE_DIR")
+        return cls(Path(cache_dir) if cache_dir else None)
+
+    @staticmethod
+    def make_key(model: str, temperature: Optional[float], prompt: Any, tag: str = "") -> str:
+        payload = json.dumps({"model": model, "t": temperature, "p": prompt, "tag": tag}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            raw = self._memory.get(key)
+            if raw is None and self._conn is not None:
+                row = self._conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    raw = self._memory[key] = row[0]
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key: str, value: Any) -> None:
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._memory[key] = raw
+            if self._conn is not None:
+                self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", (key, raw))
+                self._conn.commit()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return f"LLM cache: {self.hits} hits / {self.misses} misses ({ratio:.1f}% hit rate)"
+
+
+class TokenUsageStats:
+    """Per-model token spend plus DeepSeek prefix-cache hits (``prompt_cache_hit_tokens``)."""
+
+    def __init__(self) -> None:
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        # model -> [prompt_tokens, completion_tokens]
+        self.by_model: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def record(self, message: Any, model: str) -> None:
+        usage = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+        meta = getattr(message, "usage_metadata", None) or {}
+        if not usage and not meta:
+            # 流式响应只在最后一个 chunk 带 usage
+            return
+        prompt_tokens = usage.get("prompt_tokens", meta.get("input_tokens", 0))
+        completion_tokens = usage.get("completion_tokens", meta.get("output_tokens", 0))
+        hit = usage.get("prompt_cache_hit_tokens")
+        if hit is None:
+            hit = (meta.get("input_token_details") or {}).get("cache_read", 0)
+        miss = usage.get("prompt_cache_miss_tokens", prompt_tokens - hit)
+        with self._lock:
+            self.hit_tokens += hit
+            self.miss_tokens += miss
+            spent = self.by_model.setdefault(model, [0, 0])
+            spent[0] += prompt_tokens
+            spent[1] += completion_tokens
+
+    def stats(self) -> str:
+        total = self.hit_tokens + self.miss_tokens
+        ratio = self.hit_tokens / total * 100 if total else 0.0
+        lines = [f"Prompt prefix cache: {self.hit_tokens} hit / {self.miss_tokens} miss tokens ({ratio:.1f}% hit rate)"]
+        lines.extend(
+            f"  {model}: {prompt} prompt + {completion} completion tokens"
+            for model, (prompt, completion) in sorted(self.by_model.items())
+        )
+        return "\n".join(lines)
@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import os
+import weakref
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class _PerLoopEmbeddings:
+    """Builds one ``OpenAIEmbeddings`` per event loop; its async HTTP pool cannot outlive the loop."""
+
+    def __init__(self, **kwargs: Any) -> None:
+        self.kwargs = kwargs
+        self._by_loop: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        if loop not in self._by_loop:
+            from langchain_openai import OpenAIEmbeddings
+
+            self._by_loop[loop] = OpenAIEmbeddings(**self.kwargs)
+        return await self._by_loop[loop].aembed_documents(texts)
+
+
+class SemanticDeduper:
+    """Drops questions whose embedding is within ``threshold`` cosine similarity of an accepted one.
+
+    Disabled unless ``EMBEDDING_MODEL`` is set; ``EMBEDDING_API_BASE`` / ``EMBEDDING_API_KEY``
+    point it at any OpenAI-compatible embeddings endpoint.
+    """
+
+    def __init__(self, embeddings: Any, threshold: float = 0.92) -> None:
+        self.embeddings = embeddings
+        self.threshold = threshold
+        # 已接收题目的单位向量，按容量倍增预分配，避免每条都 vstack 拷贝
+        self._matrix: Optional[np.ndarray] = None
+        self._size = 0
+        # 已通过去重、仍在评审中的候选向量，并发评审的批次之间也要互相比较
+        self._pending: Dict[int, np.ndarray] = {}
+        self._handles = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> Optional["SemanticDeduper"]:
+        model = os.getenv("EMBEDDING_MODEL")
+        if not model:
+            return None
+        embeddings = _PerLoopEmbeddings(
+            model=model,
+            base_url=os.getenv("EMBEDDING_API_BASE") or None,
+            api_key=os.getenv("EMBEDDING_API_KEY") or None,
+            check_embedding_ctx_length=False,
+            # 重试与 429 退避由 DatasetSynthesizer 统一负责，SDK 内不再叠加重试
+            timeout=30,
+            max_retries=0,
+        )
+        return cls(embeddings, threshold=float(os.getenv("EMBEDDING_DEDUP_THRESHOLD", "0.92")))
+
+    async def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.asarray(await self.embeddings.aembed_documents(list(texts)), dtype=np.float32)
+        return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+    async def novel(self, vectors: np.ndarray) -> List[int]:
+        """Indices of ``vectors`` not near an accepted, pending, or earlier vector in the batch."""
+        parts = [self._matrix[: self._size]] if self._size else []
+        if self._pending:
+            parts.append(np.stack(list(self._pending.values())))
+        reference = np.concatenate(parts) if parts else None
+        # 矩阵乘法放到工作线程，事件循环继续处理其它完成的请求
+        return await asyncio.to_thread(self._novel, vectors, reference)
+
+    def _novel(self, vectors: np.ndarray, reference: Optional[np.ndarray]) -> List[int]:
+        seen_max = (
+            (vectors @ reference.T).max(axis=1)
+            if reference is not None
+            else np.full(len(vectors), -1.0, dtype=np.float32)
+        )
+        batch_sims = vectors @ vectors.T
+        keep: List[int] = []
+        for i in range(len(vectors)):
+            if seen_max[i] > self.threshold:
+                continue
+            if keep and batch_sims[i, keep].max() > self.threshold:
+                continue
+            keep.append(i)
+        return keep
+
+    def hold(self, vector: np.ndarray) -> int:
+        """Register a candidate under review so concurrent batches are compared against it."""
+        handle = next(self._handles)
+        self._pending[handle] = vector
+        return handle
+
+    def release(self, handle: int) -> Optional[np.ndarray]:
+        return self._pending.pop(handle, None)
+
+    def add(self, vector: np.ndarray) -> None:
+        if self._matrix is None:
+            self._matrix = np.empty((64, vector.shape[-1]), dtype=np.float32)
+        elif self._size == len(self._matrix):
+            self._matrix = np.concatenate([self._matrix, np.empty_like(self._matrix)])
+        self._matrix[self._size] = vector
+        self._size += 1
@@ -1,36 +1,100 @@
 import argparse
-import json
+import asyncio
 from pathlib import Path
 
-from .agents import DatasetSynthesizer, PlannerAgent, ReviewerAgent, WriterAgent
+import msgspec
 
+from .agents import (
+    DEEPSEEK_FAST_MODEL,
+    DEEPSEEK_STRONG_MODEL,
+    LLM_CACHE,
+    TOKEN_USAGE,
+    DatasetSynthesizer,
+    PlannerAgent,
+    ReviewerAgent,
+    WriterAgent,
+    _build_client,
+    _close_loop_clients,
+)
+from .dedup import SemanticDeduper
 
-def run(
+
+async def arun(
     topic: str,
     num_questions: int,
     output_path: Path,
     min_score: float | None = None,
     max_attempts: int | None = None,
     use_outline: bool = False,
+    skip_review: bool = False,
 ) -> None:
-    planner = PlannerAgent()
-    writer = WriterAgent()
-    reviewer = ReviewerAgent()
-    synth = DatasetSynthesizer(planner, writer, reviewer)
-
-    dataset = synth.build(
-        topic=topic,
-        num_questions=num_questions,
-        min_score=min_score,
-        max_attempts=max_attempts,
-        use_outline=use_outline,
+    # 规划 0.2、出题 0.7（easy/medium 走 FAST，hard 走 STRONG）、评审 0.2 走 FAST，共享同一个连接池
+    planner = PlannerAgent(_build_client(0.2))
+    writer = WriterAgent(
+        _build_client(0.7, model=DEEPSEEK_STRONG_MODEL),
+        fast_client=_build_client(0.7, model=DEEPSEEK_FAST_MODEL),
+        novelty_client=_build_client(1.0, model=DEEPSEEK_STRONG_MODEL),
+        fast_novelty_client=_build_client(1.0, model=DEEPSEEK_FAST_MODEL),
     )
+    reviewer = ReviewerAgent(_build_client(0.2, model=DEEPSEEK_FAST_MODEL))
+    # 设置 EMBEDDING_MODEL 时额外启用嵌入语义去重
+    synth = DatasetSynthesizer(planner, writer, reviewer, deduper=SemanticDeduper.from_env())
+
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    output_path.write_text(
-        json.dumps([item.__dict__ for item in dataset], ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-    print(f"Saved {len(dataset)} samples to {output_path}")
+    saved = 0
+    # 边生成边追加 JSONL，中途崩溃也不会丢失已生成的样本
+    with output_path.open("wb", buffering=1024 * 1024) as fh:
+
+        def _write(items) -> None:
+            fh.writelines(msgspec.json.encode(item) + b"\n" for item in items)
+
+        async def _flush(items) -> None:
+            nonlocal saved
+            # 编码与写盘放到工作线程，事件循环继续发出新的 LLM 请求
+            await asyncio.to_thread(_write, items)
+            saved += len(items)
+
+        await synth.abuild(
+            topic=topic,
+            num_questions=num_questions,
+            min_score=min_score,
+            max_attempts=max_attempts,
+            use_outline=use_outline,
+            flush_every=16,
+            flush_callback=_flush,
+            skip_review=skip_review,
+            keep_items=False,
+        )
+    print(f"Saved {saved} samples to {output_path}")
+    print(LLM_CACHE.stats())
+    print(TOKEN_USAGE.stats())
+
+
+def run(
+    topic: str,
+    num_questions: int,
+    output_path: Path,
+    min_score: float | None = None,
+    max_attempts: int | None = None,
+    use_outline: bool = False,
+    skip_review: bool = False,
+) -> None:
+
+    async def _main() -> None:
+        try:
+            await arun(
+                topic=topic,
+                num_questions=num_questions,
+                output_path=output_path,
+                min_score=min_score,
+                max_attempts=max_attempts,
+                use_outline=use_outline,
+                skip_review=skip_review,
+            )
+        finally:
+            await _close_loop_clients()
+
+    asyncio.run(_main())
 
 
 def parse_args() -> argparse.Namespace:
@@ -47,14 +111,15 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         "--output",
         type=Path,
-        default=Path("data/teacher_generated.json"),
-        help="Where to save the synthesized dataset",
+        default=Path("data/teacher_generated.jsonl"),
+        help="Where to save the synthesized dataset (JSONL, appended while generating)",
     )
     parser.add_argument(
         "--min-score",
         type=float,
         default=None,
-        help="Optional reviewer score threshold; samples below are dropped",
+        help="Optional reviewer score threshold; samples below are dropped. "
+        "Reviewing roughly doubles API spend, so the reviewer only runs when this is set",
     )
     parser.add_argument(
         "--max-attempts",
@@ -67,6 +132,11 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="If set, will generate multi-point outline and teaching notes (slower, richer). Default is off for faster QA-only generation.",
     )
+    parser.add_argument(
+        "--skip-review",
+        action="store_true",
+        help="Never call the reviewer, even with --min-score (debugging; halves API calls)",
+    )
     return parser.parse_args()
 
 
@@ -79,6 +149,7 @@ def main() -> None:
         min_score=args.min_score,
         max_attempts=args.max_attempts,
         use_outline=args.use_outline,
+        skip_review=args.skip_review,
     )
 
 
@@ -0,0 +1,21 @@
+import pytest
+
+from src.teacher.agents import WriterAgent
+
+
+@pytest.mark.parametrize(
+    "reply, expected",
+    [
+        ("问题：什么是商誉？\n答案：并购成本超过可辨认净资产公允价值的部分", ("什么是商誉？", "并购成本超过可辨认净资产公允价值的部分")),
+        ("问：A\n答：B", ("A", "B")),
+        ("问题: x 答案: y", ("x", "y")),
+        # 题干里出现 "回答：" 时不能被当成答案分隔符
+        ("问题：请简要回答：什么是折现率？\n答案：把未来现金流折算为现值的比率", ("请简要回答：什么是折现率？", "把未来现金流折算为现值的比率")),
+        ("问：如何回答：持有至到期投资如何计量？\n答：按摊余成本计量", ("如何回答：持有至到期投资如何计量？", "按摊余成本计量")),
+        ("问：A 答：B", ("A", "B")),
+        ("问题：请简要回答：X 答案：Y", ("请简要回答：X", "Y")),
+        ("没有分隔符", ("没有分隔符", "")),
+    ],
+)
+def test_parse_qa(reply, expected):
+    assert WriterAgent._parse_qa(reply) == expected